@@ -7,7 +7,8 @@
 # -----------------------------------------------------------------------------
 
 from qiita_client import QiitaPlugin, QiitaCommand
-from .qp_fastp_minimap2 import get_dbs_list, fastp_minimap2
+from .qp_fastp_minimap2 import (
+    get_dbs_list, fastp_minimap2, fastp_minimap2_quick_look, QUICK_LOOK_READS)
 from .utils import plugin_details
 from os.path import splitext
 
@@ -42,3 +43,29 @@ fastp_minimap2_cmd = QiitaCommand(
     opt_params, outputs, default_params)
 
 plugin.register_command(fastp_minimap2_cmd)
+
+# Define the quick-look command, it runs the same commands as the full
+# command but only over the first reads of each file and within the plugin
+# so it doesn't need to wait for the queue
+opt_params = {
+    'reference': [
+        f'choice:["None", {dbs_defaults}]', dbs_without_extension[0]],
+    'threads': ['integer', f'{THREADS}'],
+    'reads': ['integer', f'{QUICK_LOOK_READS}']}
+default_params = {
+    'fastp_known_adapters_formatted.fna only filtering': {
+        'reference': "None", 'threads': THREADS, 'reads': QUICK_LOOK_READS}}
+for db in dbs_without_extension:
+    name = f'fastp_known_adapters_formatted.fna and {db} + phix filtering'
+    default_params[name] = {
+        'reference': db, 'threads': THREADS, 'reads': QUICK_LOOK_READS}
+outputs = {'Filtered files': 'per_sample_FASTQ',
+           'Quick-look summary': 'job-output-folder'}
+
+fastp_minimap2_quick_look_cmd = QiitaCommand(
+    'Adapter and host filtering quick-look v2023.12',
+    "Sequence adapter and host filtering over the first reads of each file",
+    fastp_minimap2_quick_look, req_params, opt_params, outputs,
+    default_params)
+
+plugin.register_command(fastp_minimap2_quick_look_cmd)
@@ -5,11 +5,22 @@
 #
 # The full license is in the file LICENSE, distributed with this software.
 # -----------------------------------------------------------------------------
-from os import environ
-from os.path import basename, join, abspath, dirname
+from os import environ, listdir, stat, makedirs, killpg, rename, remove
+from os.path import (
+    basename, join, abspath, dirname, isdir, exists, splitext)
+from re import match, IGNORECASE
+from shlex import quote
 from glob import glob
-from itertools import zip_longest
-from shutil import copyfile
+from hashlib import md5
+from itertools import zip_longest, islice
+from json import load
+import gzip
+from functools import partial
+from shutil import copyfile, rmtree
+from subprocess import run, Popen, PIPE, STDOUT, TimeoutExpired
+from signal import SIGKILL
+from time import time, sleep
+from zlib import decompressobj, MAX_WBITS
 
 from qiita_client import ArtifactInfo
 
@@ -18,11 +29,45 @@ WALLTIME = '30:00:00'
 FINISH_MEMORY = '10g'
 FINISH_WALLTIME = '10:00:00'
 MAX_RUNNING = 8
+QUICK_LOOK_READS = 10000
+# the quick-look runs within the plugin so it has a hard limit, in seconds,
+# for all its samples; the ones that don't finish in time are listed in the
+# summary without results
+QUICK_LOOK_TIMEOUT = 15 * 60
+# array tasks that run out of memory or time are resubmitted with twice the
+# memory or walltime until they have been tried MAX_ATTEMPTS times
+MAX_ATTEMPTS = 3
+RETRY_STATES = {'OUT_OF_MEMORY': 'memory', 'TIMEOUT': 'walltime'}
+# sacct can lag behind, or be disabled, so it's queried a few times before
+# falling back to the markers the tasks write once their command succeeded
+SACCT_ATTEMPTS = 3
+SACCT_WAIT = 30
+CHUNK_SIZE = 4 * 1024 ** 2
+
+# the versions pinned in the CI, checked by every task
+TOOL_VERSIONS = {'fastp': '0.23.4', 'minimap2': '2.17', 'samtools': '1.11'}
+ENVIRONMENT_MARKER = '__qp_fastp_minimap2__'
+# variables that bash changes by itself
+IGNORED_VARIABLES = {'_', 'PWD', 'OLDPWD', 'SHLVL'}
+# variables that belong to the host or session running each task, Slurm or
+# the node set them so they are never taken from the submission
+HOST_VARIABLES = {'TMPDIR', 'XDG_RUNTIME_DIR', 'HOSTNAME', 'OMP_NUM_THREADS'}
+HOST_PREFIXES = ('SLURM_', 'SSH_')
 
 QC_REFERENCE_DB = environ["QC_REFERENCE_DB"]
+# optional store of fastp-trimmed reads so filtering the same input against
+# other references doesn't need to run fastp again; its size is in GB
+QC_FASTP_CACHE = environ.get("QC_FASTP_CACHE")
+QC_FASTP_CACHE_SIZE = int(environ.get("QC_FASTP_CACHE_SIZE", 500))
+# optional memory of the tasks mapping against a split index, only the
+# references with a split index are affected; the peak memory depends on the
+# part size used to build them, see build_split_index
+QC_SPLIT_INDEX_MEMORY = environ.get("QC_SPLIT_INDEX_MEMORY")
+SPLIT_INDEX_SUFFIX = '.split.mmi'
+SPLIT_INDEX_PART_SIZE = '1G'
 
 FASTP_BASE = 'fastp -l 100 -i %s -w {nprocs} --adapter_fasta {adapter_fasta}'
-MINIMAP2_BASE = 'minimap2 -ax sr -t {nprocs} {database} - -a '
+MINIMAP2_BASE = 'minimap2 -ax sr -t {nprocs} {split_prefix}{database} - -a '
 SAMTOOLS_BASE = 'samtools fastq -@ {nprocs} -f '
 
 FASTP_CMD = ' '.join([FASTP_BASE, '-I %s -o {out_dir}/%s -O {out_dir}/%s'])
@@ -35,15 +80,665 @@ COMBINED_CMD_SINGLE = (f'{FASTP_BASE} --stdout | {MINIMAP2_BASE} | '
                        f'{SAMTOOLS_BASE} 4 -0 '
                        '{out_dir}/%s')
 
+# the cached versions key the trimmed reads by the input files, see
+# _fastp_cache_key, and the fastp settings; a miss first makes room for the
+# new entry and then runs fastp into a temporary folder that is atomically
+# renamed so concurrent tasks never see a partial entry
+FASTP_CACHE_BASE = ('cdir={fastp_cache}/{settings}-%s; '
+                    'if [ ! -d $cdir ]; then '
+                    'prune_qp_fastp_minimap2 {fastp_cache} {fastp_cache_size} '
+                    '|| true; tdir=$cdir.$(hostname).$$; mkdir -p $tdir; ')
+FASTP_CACHE_STORE = ('mv -T $tdir $cdir || rm -rf $tdir; fi; touch $cdir; ')
+MINIMAP2_CACHED_BASE = 'minimap2 -ax sr -t {nprocs} {split_prefix}{database} '
+CACHED_CMD = (f'{FASTP_CACHE_BASE}{FASTP_BASE} -I %s -o $tdir/R1.fastq.gz '
+              f'-O $tdir/R2.fastq.gz -z 1; {FASTP_CACHE_STORE}'
+              f'{MINIMAP2_CACHED_BASE}$cdir/R1.fastq.gz $cdir/R2.fastq.gz '
+              f'-a | {SAMTOOLS_BASE} 12 -F 256 -1 '
+              '{out_dir}/%s -2 {out_dir}/%s')
+CACHED_CMD_SINGLE = (f'{FASTP_CACHE_BASE}{FASTP_BASE} -o $tdir/R1.fastq.gz '
+                     f'-z 1; {FASTP_CACHE_STORE}'
+                     f'{MINIMAP2_CACHED_BASE}$cdir/R1.fastq.gz -a | '
+                     f'{SAMTOOLS_BASE} 4 -0 '
+                     '{out_dir}/%s')
+
+# minimap2 reads the queries once per part of a split index so they can't
+# come from stdin, fastp writes them to a scratch folder instead, which also
+# holds the temporary files of each part; the folder is removed whenever the
+# task exits and, as a killed task can't remove it, it's in the node's scratch
+# space instead of the job's folder
+SPLIT_BASE = ('sdir=$(mktemp -d ${{TMPDIR:-/tmp}}/qp-fastp-minimap2.XXXXXX); '
+              "trap 'rm -rf $sdir' EXIT; ")
+SPLIT_CMD = (f'{SPLIT_BASE}{FASTP_BASE} -I %s -o $sdir/R1.fastq.gz '
+             '-O $sdir/R2.fastq.gz -z 1; '
+             f'{MINIMAP2_CACHED_BASE}$sdir/R1.fastq.gz $sdir/R2.fastq.gz '
+             f'-a | {SAMTOOLS_BASE} 12 -F 256 -1 '
+             '{out_dir}/%s -2 {out_dir}/%s')
+SPLIT_CMD_SINGLE = (f'{SPLIT_BASE}{FASTP_BASE} -o $sdir/R1.fastq.gz -z 1; '
+                    f'{MINIMAP2_CACHED_BASE}$sdir/R1.fastq.gz -a | '
+                    f'{SAMTOOLS_BASE} 4 -0 '
+                    '{out_dir}/%s')
+
+# the outputs are written to fifos that stats_qp_fastp_minimap2 streams into
+# the final files, recording their md5, size and number of records in a
+# sidecar file while they are written; the sidecar is only moved next to the
+# output once the whole command succeeded
+STATS_SUFFIX = '.stats'
+STATS_CMD = ('stats_qp_fastp_minimap2 {fifo_dir}/%s {out_dir}/%s '
+             '{fifo_dir}/%s' f'{STATS_SUFFIX} & ')
 
-def get_dbs_list():
+
+def get_dbs_list(split=False):
     folder = QC_REFERENCE_DB
 
+    # split indexes are an alternative to the regular one with the same name
+    if split:
+        dbs = glob(f'{folder}/*{SPLIT_INDEX_SUFFIX}')
+    else:
+        dbs = [f for f in glob(f'{folder}/*.mmi')
+               if not f.endswith(SPLIT_INDEX_SUFFIX)]
+
     # skip human database
-    return [basename(f) for f in glob(f'{folder}/*.mmi') if 'human' not in f]
+    return [basename(f) for f in dbs if 'human' not in f]
+
+
+def _get_database(reference):
+    """Returns the path of the reference database or None"""
+    database = None
+    if reference != 'None':
+        database = [join(QC_REFERENCE_DB, f'{db}')
+                    for db in get_dbs_list()
+                    if reference in db][0]
+        if QC_SPLIT_INDEX_MEMORY is not None:
+            split = f'{splitext(basename(database))[0]}{SPLIT_INDEX_SUFFIX}'
+            if split in get_dbs_list(split=True):
+                database = join(QC_REFERENCE_DB, split)
+
+    return database
+
+
+def build_split_index(fasta_fp, name, part_size):
+    """Builds a split index of fasta_fp in QC_REFERENCE_DB
+
+    Parameters
+    ----------
+    fasta_fp : str
+        The path to the reference sequences
+    name : str
+        The name of the reference, it should match the name of the regular
+        index so it can be used instead of it
+    part_size : str
+        The number of bases of each part, like 1G; minimap2 only loads one
+        part at a time, which for the sr preset takes roughly 2.5 bytes per
+        base, and needs a few more GB to map, so 1G parts fit in a
+        QC_SPLIT_INDEX_MEMORY of about 6g. minimap2's own default, 4G, makes
+        a single part for a human reference and so saves no memory
+
+    Returns
+    -------
+    str
+        The path to the split index
+
+    Raises
+    ------
+    ValueError
+        If minimap2 fails
+    """
+    index_fp = join(QC_REFERENCE_DB, f'{name}{SPLIT_INDEX_SUFFIX}')
+    # building in a temporary file so get_dbs_list never lists a partial index
+    tmp_fp = f'{index_fp}.tmp'
+    res = run(['minimap2', '-x', 'sr', '-I', part_size, '-d', tmp_fp,
+               fasta_fp], stdout=PIPE, stderr=PIPE)
+    if res.returncode != 0:
+        if exists(tmp_fp):
+            remove(tmp_fp)
+        raise ValueError(res.stderr.decode('utf8'))
+    rename(tmp_fp, index_fp)
+
+    return index_fp
+
+
+def _fastp_settings(adapter_fasta):
+    """Returns the key of the fastp settings used to trim the reads"""
+    settings = md5(FASTP_BASE.encode())
+    with open(adapter_fasta, 'rb') as f:
+        settings.update(f.read())
+
+    return settings.hexdigest()[:8]
+
+
+def _fastp_cache_key(fps, checksums=None):
+    """Returns the key of the input files fps in the fastp cache
+
+    Parameters
+    ----------
+    fps : list of str
+        The paths to the input files, None values are ignored
+    checksums : dict of {str: str}, optional
+        The checksums that Qiita stored for the input files
+
+    Returns
+    -------
+    str
+        The key of the inputs
+
+    Notes
+    -----
+    Reading the inputs again to hash them would double the I/O of every task,
+    instead the key is computed at submission from their path, size and
+    modification time, which Qiita never changes, and their checksum if known
+    """
+    if checksums is None:
+        checksums = {}
+    key = md5()
+    for fp in fps:
+        if fp is None:
+            continue
+        info = stat(fp)
+        key.update(f'{fp}\t{info.st_size}\t{info.st_mtime_ns}\t'
+                   f'{checksums.get(fp)}\n'.encode())
+
+    return key.hexdigest()
+
+
+def _walltime_seconds(walltime):
+    """Returns the number of seconds of a Slurm walltime like 30:00:00
+
+    Raises
+    ------
+    ValueError
+        If walltime is not in one of the formats accepted by Slurm
+    """
+    res = match(r'^(?:(\d+)-)?(\d+)(?::(\d+))?(?::(\d+))?$', walltime)
+    if res is None:
+        raise ValueError(f'Invalid walltime: {walltime}')
+    days, hours, minutes, seconds = [int(x or 0) for x in res.groups()]
+    # days-hours[:minutes[:seconds]] and hours:minutes:seconds are read as
+    # is, but without days and with less than 3 fields it's minutes[:seconds]
+    if res.group(1) is None and res.group(4) is None:
+        hours, minutes, seconds = 0, hours, minutes
+
+    return days * 86400 + hours * 3600 + minutes * 60 + seconds
+
+
+def _prune_fastp_cache(fastp_cache, max_size, grace=None):
+    """Removes the least recently used entries until fastp_cache fits max_size
+
+    Parameters
+    ----------
+    fastp_cache : str
+        The folder storing the fastp-trimmed reads
+    max_size : int
+        The maximum size in bytes of fastp_cache
+    grace : int, optional
+        The seconds after their last write that the entries still being
+        written are kept, by default the walltime of a task
+
+    Returns
+    -------
+    list of str
+        The removed entries
+    """
+    if grace is None:
+        grace = _walltime_seconds(WALLTIME)
+
+    entries = []
+    total = 0
+    removed = []
+    for entry in listdir(fastp_cache):
+        fp = join(fastp_cache, entry)
+        if not isdir(fp):
+            continue
+        try:
+            stats = [stat(fp)] + [stat(f) for f in glob(f'{fp}/*')]
+        except FileNotFoundError:
+            # renamed or removed by a task while we were looking at it
+            continue
+        size = sum([s.st_size for s in stats[1:]])
+        # entries still being written are named {key}.{hostname}.{pid}, the
+        # ones whose task was killed are never renamed so they are removed
+        # once nothing has been written to them for longer than grace
+        if '.' in entry:
+            if time() - max([s.st_mtime for s in stats]) > grace:
+                rmtree(fp, ignore_errors=True)
+                removed.append(fp)
+            else:
+                total += size
+            continue
+        entries.append((stats[0].st_mtime, size, fp))
+
+    total += sum([size for _, size, _ in entries])
+    for _, size, fp in sorted(entries):
+        if total <= max_size:
+            break
+        rmtree(fp, ignore_errors=True)
+        total -= size
+        removed.append(fp)
+
+    return removed
+
+
+def stream_stats(in_fp, out_fp, stats_fp=None):
+    """Copies in_fp to out_fp and records its md5, size and number of records
+
+    Parameters
+    ----------
+    in_fp : str
+        The path to read from, normally a fifo
+    out_fp : str
+        The path to write to; if it ends in .gz the number of records is
+        computed over the decompressed stream
+    stats_fp : str, optional
+        The path to write the md5, size and number of records to, by default
+        out_fp + STATS_SUFFIX
+
+    Returns
+    -------
+    str, int, int
+        The md5, size and number of records of out_fp
+
+    Raises
+    ------
+    ValueError
+        If out_fp ends in .gz and its last gzip member is incomplete, in which
+        case no stats are written
+    """
+    if stats_fp is None:
+        stats_fp = f'{out_fp}{STATS_SUFFIX}'
+    checksum = md5()
+    size = 0
+    lines = 0
+    compressed = out_fp.endswith('.gz')
+    truncated = False
+    # gzip auto-detection, the outputs can have multiple gzip members
+    decompressor = decompressobj(MAX_WBITS | 16)
+    with open(in_fp, 'rb') as fin, open(out_fp, 'wb') as fout:
+        for chunk in iter(partial(fin.read, CHUNK_SIZE), b''):
+            fout.write(chunk)
+            checksum.update(chunk)
+            size += len(chunk)
+            if not compressed:
+                lines += chunk.count(b'\n')
+                continue
+            while chunk:
+                lines += decompressor.decompress(chunk).count(b'\n')
+                truncated = not decompressor.eof
+                if truncated:
+                    break
+                chunk = decompressor.unused_data
+                decompressor = decompressobj(MAX_WBITS | 16)
+
+    # a writer killed mid-stream closes the fifo like one that finished, the
+    # only difference is the gzip member that was never completed
+    if truncated:
+        raise ValueError(f'{out_fp} is truncated')
+
+    checksum = checksum.hexdigest()
+    records = lines // 4
+    with open(stats_fp, 'w') as f:
+        f.write(f'{checksum}\t{size}\t{records}\n')
+
+    return checksum, size, records
+
+
+def _stream_outputs(command, fnames, out_dir):
+    """Wraps command so its outputs are streamed through stream_stats"""
+    fifo_dir = join(out_dir, 'fifos')
+    fifos = [f'{fifo_dir}/{fname}' for fname in fnames]
+    pending = [f'{fifo}{STATS_SUFFIX}' for fifo in fifos]
+    final = [f'{out_dir}/{fname}{STATS_SUFFIX}' for fname in fnames]
+    # each reader is waited for by its pid, a bare wait always succeeds
+    stats = ''.join([
+        STATS_CMD.format(fifo_dir=fifo_dir, out_dir=out_dir) % (
+            fname, fname, fname) + f'pid{i}=$!; '
+        for i, fname in enumerate(fnames)])
+    waits = ''.join([f'wait $pid{i}; ' for i in range(len(fnames))])
+    moves = ''.join([f'mv {p} {f}; ' for p, f in zip(pending, final)])
+
+    # a killed task, e.g. for running out of memory, never removes its fifos
+    # so they, and any stats of a previous attempt, need to be removed before
+    # retrying it; pipefail so a tool killed in the middle of a pipe fails the
+    # command instead of the next tool finishing with partial input
+    return (f'set -o pipefail; mkdir -p {fifo_dir}; '
+            f'rm -f {" ".join(fifos + pending + final)}; '
+            f'mkfifo {" ".join(fifos)}; {stats}{command}; {waits}'
+            f'{moves}rm {" ".join(fifos)}')
+
+
+def _collect_stats(out_files):
+    """Collects the stats that stream_stats recorded for out_files
+
+    Parameters
+    ----------
+    out_files : list of (str, str)
+        The filepaths and filepath types of the outputs
+
+    Returns
+    -------
+    list of str, list of str
+        The tab separated filepath, filepath type, md5, size and number of
+        records of each output, and the names of the outputs without stats or
+        whose size doesn't match its stats
+    """
+    # the md5, size and number of records were computed while the files were
+    # written so there is no need to read them again, we only make sure that
+    # they were completely written
+    stats = []
+    incomplete = []
+    for fp, ft in out_files:
+        stats_fp = f'{fp}{STATS_SUFFIX}'
+        if not exists(stats_fp):
+            incomplete.append(basename(fp))
+            continue
+        with open(stats_fp) as f:
+            checksum, size, records = f.read().split()
+        if int(size) != stat(fp).st_size:
+            incomplete.append(basename(fp))
+            continue
+        stats.append('\t'.join([fp, ft, checksum, size, records]))
+
+    return stats, incomplete
+
+
+def _escalate_resources(memory, walltime, states):
+    """Doubles the memory and/or walltime depending on the failed states
+
+    Parameters
+    ----------
+    memory : str
+        The memory of the failed tasks, like 16g
+    walltime : str
+        The walltime of the failed tasks, like 30:00:00
+    states : set of str
+        The Slurm states of the failed tasks
+
+    Returns
+    -------
+    str, str
+        The memory and walltime for the next attempt
+
+    Raises
+    ------
+    ValueError
+        If memory or walltime are not in a format accepted by Slurm
+    """
+    resources = {RETRY_STATES[s] for s in states if s in RETRY_STATES}
+    if 'memory' in resources:
+        # megabytes unless there is a unit, like 16g or 16GB
+        res = match(r'^(\d+)([KMGT]B?)?$', memory, IGNORECASE)
+        if res is None:
+            raise ValueError(f'Invalid memory: {memory}')
+        memory = f'{int(res.group(1)) * 2}{res.group(2) or ""}'
+    if 'walltime' in resources:
+        seconds = 2 * _walltime_seconds(walltime)
+        walltime = (f'{seconds // 3600}:{seconds % 3600 // 60:02d}:'
+                    f'{seconds % 60:02d}')
+
+    return memory, walltime
+
+
+def _parse_sacct(output):
+    """Parses `sacct -X -n -P --format JobID,State` of an array job
+
+    Parameters
+    ----------
+    output : str
+        The output of sacct
+
+    Returns
+    -------
+    dict of {int: str}
+        The state of each array index
+    """
+    states = {}
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        slurm_id, state = line.split('|')[:2]
+        # pending ranges look like 1234_[1-3] and steps like 1234_1.batch
+        index = slurm_id.split('_')[-1]
+        if not index.isdigit():
+            continue
+        # states can have details, like "CANCELLED by 1000"
+        states[int(index)] = state.split()[0]
+
+    return states
+
+
+def submit_array(main_fp, finish_fp, out_dir, job_id, indices=None,
+                 memory=None, walltime=None):
+    """Submits the array and finish jobs and records the attempt
+
+    Parameters
+    ----------
+    main_fp : str
+        The path to the array job
+    finish_fp : str
+        The path to the finish job
+    out_dir : str
+        The output directory
+    job_id : str
+        The job id
+    indices : list of int, optional
+        The array indices to resubmit with memory and walltime, by default
+        all of them are submitted as defined in main_fp
+    memory : str, optional
+        The memory of each resubmitted array task
+    walltime : str, optional
+        The walltime of each resubmitted array task
+
+    Returns
+    -------
+    str, str
+        The Slurm ids of the array and finish jobs
+
+    Raises
+    ------
+    ValueError
+        If sbatch rejects any of the jobs, in which case nothing is left
+        queued
+    """
+    cmd = ['sbatch']
+    if indices is not None:
+        # the command line options take precedence over the #SBATCH ones
+        cmd.extend([
+            '--array', f'{",".join(map(str, indices))}%{MAX_RUNNING}',
+            '--mem', memory, '--time', walltime])
+    else:
+        with open(main_fp) as f:
+            for line in f.read().splitlines():
+                if line.startswith('#SBATCH --mem '):
+                    memory = line.split()[-1]
+                elif line.startswith('#SBATCH --time '):
+                    walltime = line.split()[-1]
+        with open(join(out_dir, 'fastp_minimap2.array-details')) as f:
+            indices = list(range(1, len(f.read().split('\n')) + 1))
+    main_job = run(cmd + [main_fp], stdout=PIPE, stderr=PIPE)
+    if main_job.returncode != 0:
+        raise ValueError(f'Could not submit {main_fp}: '
+                         f'{main_job.stderr.decode("utf8")}')
+    main_job_id = main_job.stdout.decode('utf8').split()[-1]
+
+    # afterany so the finish job also runs when some tasks failed, it
+    # decides what needs to be retried
+    finish = run(['sbatch', '-d', f'afterany:{main_job_id}', finish_fp],
+                 stdout=PIPE, stderr=PIPE)
+    if finish.returncode != 0:
+        # nothing would ever look at the results of the array job
+        run(['scancel', main_job_id], stdout=PIPE, stderr=PIPE)
+        raise ValueError(f'Could not submit {finish_fp}: '
+                         f'{finish.stderr.decode("utf8")}')
+    finish_job_id = finish.stdout.decode('utf8').split()[-1]
+
+    with open(join(out_dir, f'{job_id}.array-jobs.tsv'), 'a') as f:
+        f.write(f'{main_job_id}\t{memory}\t{walltime}\t'
+                f'{",".join(map(str, indices))}\n')
+
+    return main_job_id, finish_job_id
+
+
+def retry_failed_tasks(out_dir, job_id):
+    """Resubmits the array tasks that ran out of memory or time
+
+    Parameters
+    ----------
+    out_dir : str
+        The output directory
+    job_id : str
+        The job id
+
+    Returns
+    -------
+    list of int
+        The resubmitted array indices; if empty all tasks either succeeded
+        or failed for good and the failures are listed in
+        {job_id}.failed.tsv
+    """
+    with open(join(out_dir, f'{job_id}.array-jobs.tsv')) as f:
+        attempts = [line.split('\t') for line in f.read().splitlines()]
+    slurm_id, memory, walltime, indices = attempts[-1]
+    indices = list(map(int, indices.split(',')))
+
+    for i in range(SACCT_ATTEMPTS):
+        if i:
+            sleep(SACCT_WAIT)
+        sacct = run(['sacct', '-j', slurm_id, '-X', '-n', '-P', '--format',
+                     'JobID,State'], stdout=PIPE)
+        states = _parse_sacct(sacct.stdout.decode('utf8'))
+        if all([index in states for index in indices]):
+            break
+
+    # the array indices follow the order of the forward reads, each followed
+    # by its reverse reads if any
+    samples = []
+    with open(join(out_dir, f'{job_id}.out_files.tsv')) as f:
+        for line in f.read().splitlines():
+            fp, ft = line.split()
+            if ft == 'raw_forward_seqs':
+                samples.append([])
+            samples[-1].append((fp, ft))
+
+    retry = []
+    failed = []
+    for index in indices:
+        state = states.get(index)
+        if state is None:
+            # without accounting a task is considered completed if it got to
+            # write its marker, which only happens after its command succeeded
+            state = 'UNKNOWN'
+            if exists(join(out_dir, f'{job_id}_{index}.done')):
+                state = 'COMPLETED'
+        if state == 'COMPLETED':
+            continue
+        if state in RETRY_STATES and len(attempts) < MAX_ATTEMPTS:
+            retry.append(index)
+        else:
+            failed.append((index, state))
+
+    if retry:
+        try:
+            memory, walltime = _escalate_resources(
+                memory, walltime, {states[index] for index in retry})
+            submit_array(join(out_dir, f'{job_id}.slurm'),
+                         join(out_dir, f'{job_id}.finish.slurm'), out_dir,
+                         job_id, retry, memory, walltime)
+        except ValueError as e:
+            # e.g. sbatch rejecting the escalated resources; the tasks
+            # failed for good so the job can finish listing their samples
+            print(f'Could not retry {retry}: {e}')
+            failed.extend([(index, f'{states[index]}, not retried')
+                           for index in retry])
+            retry = []
+
+    if failed:
+        with open(join(out_dir, f'{job_id}.failed.tsv'), 'a') as f:
+            for index, state in failed:
+                sample = basename(samples[index - 1][0][0])
+                f.write(f'{index}\t{sample}\t{state}\n')
+
+    return retry
+
+
+def resolve_environment(environment, out_dir, job_id):
+    """Resolves environment once into a snapshot that the tasks source
+
+    Parameters
+    ----------
+    environment : str
+        The commands that set up the environment, like
+        `source activate qp-fastp-minimap2`
+    out_dir : str
+        The output directory
+    job_id : str
+        The job id
 
+    Returns
+    -------
+    str
+        The command to load the snapshot
+
+    Raises
+    ------
+    ValueError
+        If the environment can't be set up, a tool is missing or its version
+        doesn't match TOOL_VERSIONS
+    """
+    tools = ' '.join(TOOL_VERSIONS)
+    cmd = (f'env -0\necho {ENVIRONMENT_MARKER}\n{environment}\n'
+           f'echo {ENVIRONMENT_MARKER}\ncommand -v {tools}\n'
+           f'echo {ENVIRONMENT_MARKER}\nenv -0')
+    # a clean login shell, so what environment adds or changes can be told
+    # apart from whatever this process happens to have set
+    clean = [f'{name}={environ[name]}' for name in ['HOME', 'USER', 'LOGNAME']
+             if name in environ]
+    res = run(['env', '-i'] + clean + ['bash', '-l', '-c', cmd], stdout=PIPE,
+              stderr=PIPE)
+    output = res.stdout.decode('utf8').split(f'{ENVIRONMENT_MARKER}\n')
+    if len(output) != 4:
+        raise ValueError(f'Could not set up the environment: {environment}\n'
+                         f'{res.stderr.decode("utf8")}')
+    paths = {basename(fp): fp for fp in output[2].split()}
+    missing = [t for t in TOOL_VERSIONS if t not in paths]
+    if missing:
+        raise ValueError(f'Missing tools: {", ".join(missing)}')
+
+    baseline, resolved = [
+        dict([variable.partition('=')[::2]
+              for variable in env.split('\0') if variable])
+        for env in [output[0], output[3]]]
+    # only what environment adds or changes, plus PATH so the tools are
+    # always found the same way; the tasks inherit the rest from sbatch
+    lines = [f'# {" ".join(environment.split())}']
+    for name, value in resolved.items():
+        if not match(r'^[A-Za-z_][A-Za-z0-9_]*$', name) or (
+                name in IGNORED_VARIABLES or name in HOST_VARIABLES or
+                name.startswith(HOST_PREFIXES)):
+            continue
+        if name != 'PATH' and baseline.get(name) == value:
+            continue
+        lines.append(f'export {name}={quote(value)}')
+    for tool, version in TOOL_VERSIONS.items():
+        lines.append(f'hash -p {quote(paths[tool])} {tool}')
+        lines.append(
+            f'[[ "$({tool} --version 2>&1)" == *"{version}"* ]] || '
+            f'{{ echo "wrong {tool} version, expected {version}" >&2; '
+            'exit 1; }')
+
+    snapshot_fp = join(out_dir, f'{job_id}.environment.sh')
+    with open(snapshot_fp, 'w') as f:
+        f.write('\n'.join(lines))
+        f.write('\n')
+
+    # making sure the snapshot works before submitting thousands of tasks
+    res = run(['bash', '-c', f'source {snapshot_fp}'], stdout=PIPE,
+              stderr=PIPE)
+    if res.returncode != 0:
+        raise ValueError(res.stderr.decode('utf8'))
 
-def _generate_commands(fwd_seqs, rev_seqs, database, nprocs, out_dir):
+    return f'source {snapshot_fp}'
+
+
+def _generate_commands(fwd_seqs, rev_seqs, database, nprocs, out_dir,
+                       fastp_cache=None, cache_keys=None):
     """Helper function to generate commands and facilite testing"""
 
     # copy adapter_fasta file to out_dir
@@ -55,30 +750,69 @@ def _generate_commands(fwd_seqs, rev_seqs, database, nprocs, out_dir):
     if out_dir != '/foo/bar/output':
         copyfile(source_adapter_fasta, adapter_fasta)
 
+    # without a database the fastp output is already the final output so
+    # there is nothing to reuse
+    cached = fastp_cache is not None and database is not None
+    split = database is not None and database.endswith(SPLIT_INDEX_SUFFIX)
+    settings = None
+    if cached:
+        settings = _fastp_settings(source_adapter_fasta)
+
     files = zip_longest(fwd_seqs, rev_seqs)
     if rev_seqs:
         cmd = FASTP_CMD
-        if database is not None:
+        if cached:
+            cmd = CACHED_CMD
+        elif split:
+            cmd = SPLIT_CMD
+        elif database is not None:
             cmd = COMBINED_CMD
     else:
         cmd = FASTP_CMD_SINGLE
-        if database is not None:
+        if cached:
+            cmd = CACHED_CMD_SINGLE
+        elif split:
+            cmd = SPLIT_CMD_SINGLE
+        elif database is not None:
             cmd = COMBINED_CMD_SINGLE
-    command = cmd.format(nprocs=nprocs, database=database, out_dir=out_dir,
-                         adapter_fasta=adapter_fasta)
+    # minimap2 maps against each part of a split index in turn and only merges
+    # the results correctly, i.e. a read is unmapped only if it's unmapped in
+    # all parts, if given a prefix for its temporary files
+    split_prefix = ''
+    if split:
+        split_prefix = '--split-prefix $sdir/split '
+        # the cached commands read the trimmed reads from the cache but still
+        # need the scratch folder
+        if cached:
+            cmd = f'{SPLIT_BASE}{cmd}'
+
+    # the commands write to the fifos, see _stream_outputs
+    command = cmd.format(nprocs=nprocs, database=database,
+                         split_prefix=split_prefix,
+                         out_dir=join(out_dir, 'fifos'),
+                         adapter_fasta=adapter_fasta, settings=settings,
+                         fastp_cache=fastp_cache,
+                         fastp_cache_size=QC_FASTP_CACHE_SIZE)
 
     out_files = []
     commands = []
     for i, (fwd_fp, rev_fp) in enumerate(files):
         fname = basename(fwd_fp)
+        fnames = [fname]
         out_files.append((f'{out_dir}/{fname}', 'raw_forward_seqs'))
         if rev_fp:
             rname = basename(rev_fp)
+            fnames.append(rname)
             out_files.append((f'{out_dir}/{rname}', 'raw_reverse_seqs'))
-            cmd = command % (fwd_fp, rev_fp, fname, rname)
+            if cached:
+                cmd = command % (cache_keys[i], fwd_fp, rev_fp, fname, rname)
+            else:
+                cmd = command % (fwd_fp, rev_fp, fname, rname)
+        elif cached:
+            cmd = command % (cache_keys[i], fwd_fp, fname)
         else:
             cmd = command % (fwd_fp, fname)
-        commands.append(cmd)
+        commands.append(_stream_outputs(cmd, fnames, out_dir))
 
     return commands, out_files
 
@@ -106,6 +840,10 @@ def fastp_minimap2(qclient, job_id, parameters, out_dir):
     qclient.update_job_step(
         job_id, "Step 3 of 4: Finishing fastp and minimap2")
 
+    # the tasks filled the cache whether or not the job succeeds
+    if QC_FASTP_CACHE is not None:
+        _prune_fastp_cache(QC_FASTP_CACHE, QC_FASTP_CACHE_SIZE * 1024 ** 3)
+
     ainfo = []
     # Generates 2 artifacts: one for the ribosomal
     # reads and other for the non-ribosomal reads
@@ -115,6 +853,23 @@ def fastp_minimap2(qclient, job_id, parameters, out_dir):
             fp, ft = line.split()
             out_files.append((fp, ft))
 
+    failed_fp = f'{out_dir}/{job_id}.failed.tsv'
+    if exists(failed_fp):
+        with open(failed_fp) as f:
+            failed = [line.split('\t') for line in f.read().splitlines()]
+        return False, None, ('These samples failed: ' + ', '.join(
+            [f'{sample} ({state})' for _, sample, state in failed]))
+
+    stats, incomplete = _collect_stats(out_files)
+    if incomplete:
+        return False, None, ('These files were not completely written: '
+                             f'{", ".join(incomplete)}')
+
+    with open(f'{out_dir}/{job_id}.stats.tsv', 'w') as f:
+        f.write('filepath\tfilepath_type\tmd5\tsize\trecords\n')
+        f.write('\n'.join(stats))
+        f.write('\n')
+
     # Step 4 generating artifacts
     msg = "Step 4 of 4: Generating new artifact"
     qclient.update_job_step(job_id, msg)
@@ -123,7 +878,140 @@ def fastp_minimap2(qclient, job_id, parameters, out_dir):
     return True, ainfo, ""
 
 
-def fastp_minimap2_to_array(files, out_dir, params, prep_info, url, job_id):
+def _subsample(fp, out_fp, reads):
+    """Writes the first reads records of the fastq fp to out_fp"""
+    opener = gzip.open if fp.endswith('.gz') else open
+    with opener(fp, 'rb') as fin, gzip.open(
+            out_fp, 'wb', compresslevel=1) as fout:
+        fout.writelines(islice(fin, reads * 4))
+
+
+def fastp_minimap2_quick_look(qclient, job_id, parameters, out_dir):
+    """Run fastp and minimap2 on the first reads of each file
+
+    Parameters
+    ----------
+    qclient : tgp.qiita_client.QiitaClient
+        The Qiita server client
+    job_id : str
+        The job id
+    parameters : dict
+        The parameter values to run fastp and minimap2
+    out_dir : str
+        The path to the job's output directory
+
+    Returns
+    -------
+    bool, list, str
+        The results of the job
+    """
+    qclient.update_job_step(
+        job_id, "Step 1 of 3: Collecting info and subsampling the reads")
+    files, prep = qclient.artifact_and_preparation_files(parameters['input'])
+    database = _get_database(parameters['reference'])
+    reads = parameters['reads']
+
+    sub_dir = join(out_dir, 'subsampled')
+    makedirs(sub_dir, exist_ok=True)
+    samples = []
+    fwd_seqs = []
+    rev_seqs = []
+    for sn, fs in sorted(files.items()):
+        samples.append(sn)
+        fwd_seqs.append(join(sub_dir, basename(fs[0]['filepath'])))
+        _subsample(fs[0]['filepath'], fwd_seqs[-1], reads)
+        if fs[1]:
+            rev_seqs.append(join(sub_dir, basename(fs[1]['filepath'])))
+            _subsample(fs[1]['filepath'], rev_seqs[-1], reads)
+
+    # the same commands as the full run, just over the subsampled reads
+    commands, out_files = _generate_commands(
+        fwd_seqs, rev_seqs, database, parameters['threads'], out_dir)
+
+    qclient.update_job_step(job_id, "Step 2 of 3: Running fastp and minimap2")
+    # the summary and the reports are returned as a folder, per_sample_FASTQ
+    # only takes the reads
+    summary_dir = join(out_dir, 'quick_look')
+    deadline = time() + QUICK_LOOK_TIMEOUT
+    reports = []
+    timed_out = False
+    for sn, cmd in zip(samples, commands):
+        # fastp writes its report in the current directory
+        report_dir = join(summary_dir, sn)
+        makedirs(report_dir, exist_ok=True)
+        log_fp = join(report_dir, 'commands.log')
+        with open(log_fp, 'w') as log:
+            proc = Popen(['bash', '-c', f'set -e; {cmd}'], cwd=report_dir,
+                         stdout=log, stderr=STDOUT, start_new_session=True)
+            try:
+                proc.wait(timeout=max(deadline - time(), 0))
+            except TimeoutExpired:
+                timed_out = True
+        if timed_out or proc.returncode != 0:
+            # the commands, or the stats_qp_fastp_minimap2 readers waiting
+            # for their fifos, could still be running
+            try:
+                killpg(proc.pid, SIGKILL)
+            except ProcessLookupError:
+                pass
+            proc.wait()
+            if timed_out:
+                break
+            with open(log_fp) as log:
+                return False, None, f'{sn} failed:\n{log.read()}'
+        with open(join(report_dir, 'fastp.json')) as f:
+            reports.append(load(f))
+
+    # the samples that didn't finish in time are listed in the summary
+    if not reports:
+        return False, None, (f'The quick-look did not finish within '
+                             f'{QUICK_LOOK_TIMEOUT} seconds, {samples[0]} '
+                             'was running')
+    # out_files follows the order of the samples, one or two files each
+    per_sample = len(out_files) // len(samples)
+    unfinished = samples[len(reports):]
+    finished_files = out_files[:len(reports) * per_sample]
+
+    qclient.update_job_step(job_id, "Step 3 of 3: Generating new artifact")
+    stats, incomplete = _collect_stats(finished_files)
+    if incomplete:
+        return False, None, ('These files were not completely written: '
+                             f'{", ".join(incomplete)}')
+    records = {line.split('\t')[0]: int(line.split('\t')[-1])
+               for line in stats}
+
+    summary = ['sample_name\treads\tadapter_trimmed_reads\t'
+               'passed_fastp_reads\tfiltered_reads\thost_fraction']
+    for i, (sn, report) in enumerate(zip(samples, reports)):
+        passed = report['summary']['after_filtering']['total_reads']
+        filtered = sum([records[fp] for fp, _ in out_files[
+            i * per_sample:(i + 1) * per_sample]])
+        host = 0
+        if database is not None and passed:
+            host = 1 - filtered / passed
+        summary.append('\t'.join(map(str, [
+            sn, report['summary']['before_filtering']['total_reads'],
+            report.get('adapter_cutting', {}).get('adapter_trimmed_reads', 0),
+            passed, filtered, f'{host:.4f}'])))
+    for sn in unfinished:
+        summary.append('\t'.join([sn] + ['NA'] * 5))
+
+    with open(join(summary_dir, 'quick_look.tsv'), 'w') as f:
+        f.write('\n'.join(summary))
+        f.write('\n')
+
+    ainfo = [ArtifactInfo('Quick-look summary', 'job-output-folder',
+                          [(f'{summary_dir}/', 'directory')])]
+    # the filtered reads must cover all the samples of the preparation
+    if not unfinished:
+        ainfo.insert(0, ArtifactInfo(
+            'Filtered files', 'per_sample_FASTQ', out_files))
+
+    return True, ainfo, ""
+
+
+def fastp_minimap2_to_array(files, out_dir, params, prep_info, url, job_id,
+                            checksums=None):
     """Creates files for submission of per sample fastp and minimap2
 
     Parameters
@@ -140,17 +1028,18 @@ def fastp_minimap2_to_array(files, out_dir, params, prep_info, url, job_id):
         The url to send info to
     job_id : str
         The job id
+    checksums : dict of {str: str}, optional
+        The checksums that Qiita stored for the files, if any
 
     Returns
     -------
     str, str, str
         The paths of the main_fp, finish_fp, out_files_fp
     """
-    database = None
-    if params['reference'] != 'None':
-        database = [join(QC_REFERENCE_DB, f'{db}')
-                    for db in get_dbs_list()
-                    if params['reference'] in db][0]
+    database = _get_database(params['reference'])
+    memory = MEMORY
+    if database is not None and database.endswith(SPLIT_INDEX_SUFFIX):
+        memory = QC_SPLIT_INDEX_MEMORY
 
     fwd_seqs = sorted(files['raw_forward_seqs'])
     if 'raw_reverse_seqs' in files:
@@ -163,8 +1052,13 @@ def fastp_minimap2_to_array(files, out_dir, params, prep_info, url, job_id):
     # Note that for processing we don't actually need the run_prefix so
     # we are not going to use it and simply loop over the ordered
     # fwd_seqs/rev_seqs
+    cache_keys = None
+    if QC_FASTP_CACHE is not None:
+        cache_keys = [_fastp_cache_key([fwd_fp, rev_fp], checksums)
+                      for fwd_fp, rev_fp in zip_longest(fwd_seqs, rev_seqs)]
     commands, out_files = _generate_commands(
-        fwd_seqs, rev_seqs, database, params['threads'], out_dir)
+        fwd_seqs, rev_seqs, database, params['threads'], out_dir,
+        fastp_cache=QC_FASTP_CACHE, cache_keys=cache_keys)
 
     # writing the job array details
     details_name = join(out_dir, 'fastp_minimap2.array-details')
@@ -181,7 +1075,7 @@ def fastp_minimap2_to_array(files, out_dir, params, prep_info, url, job_id):
              '#SBATCH -N 1',
              f'#SBATCH -n {PPN}',
              f'#SBATCH --time {WALLTIME}',
-             f'#SBATCH --mem {MEMORY}',
+             f'#SBATCH --mem {memory}',
              f'#SBATCH --output {out_dir}/{job_id}_%a.log',
              f'#SBATCH --error {out_dir}/{job_id}_%a.err',
              f'#SBATCH --array 1-{n_jobs}%{MAX_RUNNING}',
@@ -195,6 +1089,7 @@ def fastp_minimap2_to_array(files, out_dir, params, prep_info, url, job_id):
              'step=$(( $offset - 0 ))',
              f'cmd=$(head -n $step {details_name} | tail -n 1)',
              'eval $cmd',
+             f'touch {out_dir}/{job_id}_${{SLURM_ARRAY_TASK_ID}}.done',
              'set +e',
              'date']
     main_fp = join(out_dir, f'{job_id}.slurm')
@@ -7,19 +7,31 @@
 # -----------------------------------------------------------------------------
 from unittest import main
 from qiita_client.testing import PluginTestCase
-from os import remove, environ
-from os.path import exists, isdir, join, dirname
+from os import remove, environ, makedirs, utime, mkfifo, listdir
+from os.path import exists, isdir, join, dirname, basename
 from shutil import rmtree, copyfile
 from tempfile import mkdtemp
 from json import dumps
+from runpy import run_path
+from time import time
+from gzip import compress, decompress
+from hashlib import md5
 from itertools import zip_longest
 from functools import partial
+from subprocess import run, PIPE
+from unittest.mock import patch, MagicMock
 
-from qp_fastp_minimap2 import plugin
+from qp_fastp_minimap2 import plugin, fastp_minimap2_quick_look_cmd
 from qp_fastp_minimap2.utils import plugin_details
 from qp_fastp_minimap2.qp_fastp_minimap2 import (
     get_dbs_list, _generate_commands, fastp_minimap2_to_array, QC_REFERENCE_DB,
-    FASTP_CMD, COMBINED_CMD, FASTP_CMD_SINGLE, COMBINED_CMD_SINGLE)
+    FASTP_CMD, COMBINED_CMD, FASTP_CMD_SINGLE, COMBINED_CMD_SINGLE,
+    CACHED_CMD, CACHED_CMD_SINGLE, SPLIT_CMD, SPLIT_CMD_SINGLE, SPLIT_BASE,
+    QC_FASTP_CACHE_SIZE, _fastp_settings, _prune_fastp_cache, _fastp_cache_key,
+    _stream_outputs, stream_stats, _collect_stats, _escalate_resources,
+    _parse_sacct, resolve_environment, _subsample, submit_array,
+    retry_failed_tasks, fastp_minimap2_quick_look, fastp_minimap2,
+    _get_database, build_split_index)
 
 
 class FastpMinimap2Tests(PluginTestCase):
@@ -46,56 +58,842 @@ class FastpMinimap2Tests(PluginTestCase):
     def test_get_dbs_list(self):
         dbs = get_dbs_list()
         self.assertCountEqual(dbs, ['artifacts.mmi', 'empty.mmi'])
+        dbs = get_dbs_list(split=True)
+        self.assertCountEqual(dbs, [])
+
+    def test_split_index(self):
+        db_dir = mkdtemp()
+        self._clean_up_files.append(db_dir)
+        for db in ['artifacts.mmi', 'artifacts.split.mmi', 'empty.mmi',
+                   'human.mmi', 'human.split.mmi']:
+            with open(join(db_dir, db), 'w') as f:
+                f.write('index')
+        prefix = 'qp_fastp_minimap2.qp_fastp_minimap2'
+        files = {'raw_forward_seqs': ['/foo/S1_R1.fastq.gz'],
+                 'raw_reverse_seqs': ['/foo/S1_R2.fastq.gz']}
+        params = {'reference': 'artifacts', 'threads': 2,
+                  'environment': 'source env.sh'}
+
+        def _submission(reference):
+            params['reference'] = reference
+            main_fp, _, _ = fastp_minimap2_to_array(
+                files, self.out_dir, params, MagicMock(), 'my-url', 'my-job')
+            with open(main_fp) as f:
+                main = f.read()
+            with open(join(self.out_dir,
+                           'fastp_minimap2.array-details')) as f:
+                return main, f.read()
+
+        with patch(f'{prefix}.QC_REFERENCE_DB', db_dir):
+            self.assertCountEqual(
+                get_dbs_list(), ['artifacts.mmi', 'empty.mmi'])
+            self.assertCountEqual(
+                get_dbs_list(split=True), ['artifacts.split.mmi'])
+
+            # without QC_SPLIT_INDEX_MEMORY the split indexes are ignored
+            self.assertEqual(_get_database('artifacts'),
+                             join(db_dir, 'artifacts.mmi'))
+            main, commands = _submission('artifacts')
+            self.assertIn('\n#SBATCH --mem 16g\n', main)
+            self.assertNotIn('--split-prefix', commands)
+
+            with patch(f'{prefix}.QC_SPLIT_INDEX_MEMORY', '6g'):
+                self.assertEqual(_get_database('artifacts'),
+                                 join(db_dir, 'artifacts.split.mmi'))
+                self.assertIsNone(_get_database('None'))
+                main, commands = _submission('artifacts')
+                self.assertIn('\n#SBATCH --mem 6g\n', main)
+                self.assertIn('--split-prefix', commands)
+                self.assertIn(f' {db_dir}/artifacts.split.mmi '
+                              '$sdir/R1.fastq.gz $sdir/R2.fastq.gz -a ',
+                              commands)
+
+                # the references without a split index are left as they are
+                self.assertEqual(_get_database('empty'),
+                                 join(db_dir, 'empty.mmi'))
+                main, commands = _submission('empty')
+                self.assertIn('\n#SBATCH --mem 16g\n', main)
+                self.assertNotIn('--split-prefix', commands)
+
+    def test_build_split_index(self):
+        db_dir = mkdtemp()
+        self._clean_up_files.append(db_dir)
+        index_fp = join(db_dir, 'artifacts.split.mmi')
+        calls = []
+
+        def _minimap2(returncode, stderr=b''):
+            def _run(cmd, **kwargs):
+                calls.append(cmd)
+                # minimap2 writes the index as it goes
+                with open(cmd[cmd.index('-d') + 1], 'w') as f:
+                    f.write('index')
+                return MagicMock(returncode=returncode, stderr=stderr)
+            return _run
+
+        prefix = 'qp_fastp_minimap2.qp_fastp_minimap2'
+        with patch(f'{prefix}.QC_REFERENCE_DB', db_dir), patch(
+                f'{prefix}.run', _minimap2(0)):
+            obs = build_split_index('/foo/ref.fna', 'artifacts', '1G')
+        self.assertEqual(obs, index_fp)
+        self.assertEqual(calls, [[
+            'minimap2', '-x', 'sr', '-I', '1G', '-d', f'{index_fp}.tmp',
+            '/foo/ref.fna']])
+        self.assertEqual(listdir(db_dir), ['artifacts.split.mmi'])
+
+        # a failed build never leaves an index, partial or not, behind
+        remove(index_fp)
+        with patch(f'{prefix}.QC_REFERENCE_DB', db_dir), patch(
+                f'{prefix}.run', _minimap2(1, b'[ERROR] failed to open')):
+            with self.assertRaisesRegex(ValueError, 'failed to open'):
+                build_split_index('/foo/ref.fna', 'artifacts', '1G')
+        self.assertEqual(listdir(db_dir), [])
 
     def test_generate_commands(self):
         out_dir = '/foo/bar/output'
         params = {'database': 'artifacts', 'nprocs': 2,
-                  'out_dir': out_dir, 'adapter_fasta': join(
-                    out_dir, 'fastp_known_adapters_formatted.fna')}
+                  'out_dir': f'{out_dir}/fifos', 'adapter_fasta': join(
+                    out_dir, 'fastp_known_adapters_formatted.fna'),
+                  'split_prefix': ''}
 
         fwd_seqs = ['sz1.fastq.gz', 'sc1.fastq.gz',
                     'sa1.fastq.gz', 'sd1.fastq.gz']
         rev_seqs = ['sz2.fastq.gz', 'sc2.fastq.gz',
                     'sa2.fastq.gz', 'sd2.fastq.gz']
         obs = _generate_commands(fwd_seqs, rev_seqs, params['database'],
-                                 params['nprocs'], params['out_dir'])
+                                 params['nprocs'], out_dir)
         cmd = COMBINED_CMD.format(**params)
-        ecmds = [cmd % (f, r, f, r)
+        ecmds = [_stream_outputs(cmd % (f, r, f, r), [f, r], out_dir)
                  for f, r in zip_longest(fwd_seqs, rev_seqs)]
-        eof = [(f'{params["out_dir"]}/{f}', 'raw_forward_seqs')
+        eof = [(f'{out_dir}/{f}', 'raw_forward_seqs')
                for f in sorted(fwd_seqs)]
         for f in sorted(rev_seqs):
-            eof.append((f'{params["out_dir"]}/{f}', 'raw_reverse_seqs'))
+            eof.append((f'{out_dir}/{f}', 'raw_reverse_seqs'))
         self.assertCountEqual(obs[0], ecmds)
         self.assertCountEqual(obs[1], eof)
 
         params['database'] = None
         obs = _generate_commands(fwd_seqs, rev_seqs, params['database'],
-                                 params['nprocs'], params['out_dir'])
+                                 params['nprocs'], out_dir)
         cmd = FASTP_CMD.format(**params)
-        ecmds = [cmd % (f, r, f, r)
+        ecmds = [_stream_outputs(cmd % (f, r, f, r), [f, r], out_dir)
                  for f, r in zip_longest(fwd_seqs, rev_seqs)]
         self.assertCountEqual(obs[0], ecmds)
         self.assertCountEqual(obs[1], list(eof))
 
         params['database'] = 'artifacts'
         obs = _generate_commands(fwd_seqs, [], params['database'],
-                                 params['nprocs'], params['out_dir'])
+                                 params['nprocs'], out_dir)
         cmd = COMBINED_CMD_SINGLE.format(**params)
-        ecmds = [cmd % (f, f) for f in fwd_seqs]
-        eof = [(f'{params["out_dir"]}/{f}', 'raw_forward_seqs')
+        ecmds = [_stream_outputs(cmd % (f, f), [f], out_dir)
+                 for f in fwd_seqs]
+        eof = [(f'{out_dir}/{f}', 'raw_forward_seqs')
                for f in sorted(fwd_seqs)]
         self.assertCountEqual(obs[0], ecmds)
         self.assertCountEqual(obs[1], eof)
 
         params['database'] = None
         obs = _generate_commands(fwd_seqs, [], params['database'],
-                                 params['nprocs'], params['out_dir'])
+                                 params['nprocs'], out_dir)
         cmd = FASTP_CMD_SINGLE.format(**params)
-        ecmds = [cmd % (f, f) for f in fwd_seqs]
+        ecmds = [_stream_outputs(cmd % (f, f), [f], out_dir)
+                 for f in fwd_seqs]
         self.assertCountEqual(obs[0], ecmds)
         self.assertCountEqual(obs[1], eof)
 
+        # split indexes need a prefix for the temporary files of each part
+        # and the reads in a file as they are read once per part
+        params['database'] = 'artifacts.split.mmi'
+        params['split_prefix'] = '--split-prefix $sdir/split '
+        obs = _generate_commands(fwd_seqs, rev_seqs, params['database'],
+                                 params['nprocs'], out_dir)
+        cmd = SPLIT_CMD.format(**params)
+        ecmds = [_stream_outputs(cmd % (f, r, f, r), [f, r], out_dir)
+                 for f, r in zip_longest(fwd_seqs, rev_seqs)]
+        self.assertCountEqual(obs[0], ecmds)
+        self.assertIn('minimap2 -ax sr -t 2 --split-prefix $sdir/split '
+                      'artifacts.split.mmi $sdir/R1.fastq.gz '
+                      '$sdir/R2.fastq.gz -a ', obs[0][0])
+
+        obs = _generate_commands(fwd_seqs, [], params['database'],
+                                 params['nprocs'], out_dir)
+        cmd = SPLIT_CMD_SINGLE.format(**params)
+        ecmds = [_stream_outputs(cmd % (f, f), [f], out_dir)
+                 for f in fwd_seqs]
+        self.assertCountEqual(obs[0], ecmds)
+
+        # with or without the fastp cache, minimap2 never reads from stdin
+        for rs in [rev_seqs, []]:
+            for fastp_cache in [None, '/foo/bar/cache']:
+                obs = _generate_commands(
+                    fwd_seqs, rs, params['database'], params['nprocs'],
+                    out_dir, fastp_cache=fastp_cache,
+                    cache_keys=['key'] * len(fwd_seqs))
+                for cmd in obs[0]:
+                    self.assertNotIn('--stdout', cmd)
+                    self.assertNotIn(' - ', cmd)
+                    self.assertIn('--split-prefix $sdir/split ', cmd)
+                    # nothing temporary is written to the job's folder
+                    self.assertIn('sdir=$(mktemp -d ${TMPDIR:-/tmp}/', cmd)
+                    self.assertNotIn(f'{out_dir}/split', cmd)
+                    self.assertNotIn(f'{out_dir}/trimmed', cmd)
+
+    def test_split_scratch(self):
+        # the scratch folder is removed even if the task fails
+        scratch = join(self.out_dir, 'scratch')
+        makedirs(scratch)
+        cmd = (SPLIT_BASE.format() + f'echo $sdir > {self.out_dir}/sdir; '
+               'touch $sdir/R1.fastq.gz; false')
+        obs = run(['bash', '-c', f'set -e; {cmd}'], stdout=PIPE, stderr=PIPE,
+                  env={**environ, 'TMPDIR': scratch})
+        self.assertEqual(obs.returncode, 1)
+        with open(join(self.out_dir, 'sdir')) as f:
+            sdir = f.read().strip()
+        self.assertTrue(sdir.startswith(f'{scratch}/qp-fastp-minimap2.'))
+        self.assertEqual(listdir(scratch), [])
+
+    def test_generate_commands_fastp_cache(self):
+        out_dir = '/foo/bar/output'
+        fastp_cache = '/foo/bar/cache'
+        adapter_fasta = join(
+            dirname(dirname(__file__)), 'support_files',
+            'fastp_known_adapters', 'fastp_known_adapters_formatted.fna')
+        params = {'database': 'artifacts', 'nprocs': 2,
+                  'out_dir': f'{out_dir}/fifos', 'adapter_fasta': join(
+                    out_dir, 'fastp_known_adapters_formatted.fna'),
+                  'fastp_cache': fastp_cache, 'split_prefix': '',
+                  'fastp_cache_size': QC_FASTP_CACHE_SIZE,
+                  'settings': _fastp_settings(adapter_fasta)}
+
+        fwd_seqs = ['sz1.fastq.gz', 'sc1.fastq.gz']
+        rev_seqs = ['sz2.fastq.gz', 'sc2.fastq.gz']
+        keys = ['key1', 'key2']
+        obs = _generate_commands(fwd_seqs, rev_seqs, params['database'],
+                                 params['nprocs'], out_dir,
+                                 fastp_cache=fastp_cache, cache_keys=keys)
+        cmd = CACHED_CMD.format(**params)
+        ecmds = [_stream_outputs(cmd % (k, f, r, f, r), [f, r], out_dir)
+                 for k, f, r in zip(keys, fwd_seqs, rev_seqs)]
+        self.assertCountEqual(obs[0], ecmds)
+        # the key is computed at submission, the inputs are only read by fastp
+        self.assertIn(f'cdir={fastp_cache}/{params["settings"]}-key1; ',
+                      obs[0][0])
+        self.assertNotIn('md5sum', obs[0][0])
+        # a miss makes room in the cache before running fastp
+        self.assertIn('then prune_qp_fastp_minimap2 /foo/bar/cache '
+                      f'{QC_FASTP_CACHE_SIZE} || true; ', obs[0][0])
+
+        obs = _generate_commands(fwd_seqs, [], params['database'],
+                                 params['nprocs'], out_dir,
+                                 fastp_cache=fastp_cache, cache_keys=keys)
+        cmd = CACHED_CMD_SINGLE.format(**params)
+        ecmds = [_stream_outputs(cmd % (k, f, f), [f], out_dir)
+                 for k, f in zip(keys, fwd_seqs)]
+        self.assertCountEqual(obs[0], ecmds)
+
+        # without a database there is nothing to cache
+        obs = _generate_commands(fwd_seqs, [], None, params['nprocs'],
+                                 out_dir, fastp_cache=fastp_cache)
+        cmd = FASTP_CMD_SINGLE.format(**params)
+        ecmds = [_stream_outputs(cmd % (f, f), [f], out_dir)
+                 for f in fwd_seqs]
+        self.assertCountEqual(obs[0], ecmds)
+
+    def test_fastp_cache_key(self):
+        fp1 = join(self.out_dir, 'S1_R1.fastq.gz')
+        fp2 = join(self.out_dir, 'S1_R2.fastq.gz')
+        for fp in [fp1, fp2]:
+            with open(fp, 'w') as f:
+                f.write('0123456789')
+            utime(fp, (0, 0))
+
+        key = _fastp_cache_key([fp1, fp2])
+        self.assertEqual(key, _fastp_cache_key([fp1, fp2]))
+        self.assertEqual(
+            _fastp_cache_key([fp1, None]), _fastp_cache_key([fp1]))
+        self.assertNotEqual(key, _fastp_cache_key([fp1]))
+        self.assertNotEqual(key, _fastp_cache_key([fp2, fp1]))
+        # Qiita's checksums are part of the key when known
+        self.assertNotEqual(key, _fastp_cache_key(
+            [fp1, fp2], {fp1: '1234', fp2: '5678'}))
+        # and so are the size and modification time of the files
+        utime(fp2, (1, 1))
+        self.assertNotEqual(key, _fastp_cache_key([fp1, fp2]))
+
+    def test_prune_fastp_cache(self):
+        fastp_cache = mkdtemp()
+        self._clean_up_files.append(fastp_cache)
+
+        # 3 entries of 10 bytes, from oldest to newest, one entry still being
+        # written and one left behind by a killed task
+        entries = ['key1', 'key2', 'key3', 'key4.host.123', 'key5.host.456']
+        for i, entry in enumerate(entries):
+            fp = join(fastp_cache, entry)
+            makedirs(fp)
+            with open(join(fp, 'R1.fastq.gz'), 'w') as f:
+                f.write('0123456789')
+            utime(fp, (i, i))
+        leftover = join(fastp_cache, 'key5.host.456')
+        utime(join(leftover, 'R1.fastq.gz'), (0, 0))
+
+        # the entry being written counts towards the size but can't be
+        # removed; the leftover is older than the grace period
+        obs = _prune_fastp_cache(fastp_cache, 25)
+        self.assertCountEqual(obs, [
+            leftover, join(fastp_cache, 'key1'), join(fastp_cache, 'key2')])
+        for entry in ['key3', 'key4.host.123']:
+            self.assertTrue(exists(join(fastp_cache, entry)))
+
+        obs = _prune_fastp_cache(fastp_cache, 100)
+        self.assertEqual(obs, [])
+
+    def test_stream_stats(self):
+        in_fp = join(self.out_dir, 'in.fastq.gz')
+        out_fp = join(self.out_dir, 'out.fastq.gz')
+        # two gzip members, like the ones written by multithreaded tools
+        data = b''.join([compress(b'@r%d\nACGT\n+\nIIII\n' % i * 10)
+                         for i in range(2)])
+        with open(in_fp, 'wb') as f:
+            f.write(data)
+
+        obs = stream_stats(in_fp, out_fp)
+        exp = (md5(data).hexdigest(), len(data), 20)
+        self.assertEqual(obs, exp)
+        with open(out_fp, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        with open(f'{out_fp}.stats') as f:
+            self.assertEqual(f.read(), f'{exp[0]}\t{exp[1]}\t20\n')
+
+        # the stats can go somewhere else
+        stats_fp = join(self.out_dir, 'pending.stats')
+        obs = stream_stats(in_fp, out_fp, stats_fp)
+        self.assertEqual(obs, exp)
+        with open(stats_fp) as f:
+            self.assertEqual(f.read(), f'{exp[0]}\t{exp[1]}\t20\n')
+
+        # a writer killed in the middle of the second gzip member
+        remove(f'{out_fp}.stats')
+        with open(in_fp, 'wb') as f:
+            f.write(data[:-10])
+        with self.assertRaisesRegex(ValueError, 'out.fastq.gz is truncated'):
+            stream_stats(in_fp, out_fp)
+        self.assertFalse(exists(f'{out_fp}.stats'))
+
+    def test_collect_stats(self):
+        data = compress(b'@r1\nACGT\n+\nIIII\n')
+        in_fp = join(self.out_dir, 'in.fastq.gz')
+        with open(in_fp, 'wb') as f:
+            f.write(data)
+        fp1 = join(self.out_dir, 'S1_R1.fastq.gz')
+        fp2 = join(self.out_dir, 'S2_R1.fastq.gz')
+        fp3 = join(self.out_dir, 'S3_R1.fastq.gz')
+        out_files = [(fp1, 'raw_forward_seqs'), (fp2, 'raw_forward_seqs'),
+                     (fp3, 'raw_forward_seqs')]
+
+        stream_stats(in_fp, fp1)
+        # never streamed so it has no stats
+        copyfile(in_fp, fp2)
+        # truncated after its stats were written
+        stream_stats(in_fp, fp3)
+        with open(fp3, 'wb') as f:
+            f.write(data[:10])
+
+        stats, incomplete = _collect_stats(out_files)
+        self.assertEqual(stats, [
+            f'{fp1}\traw_forward_seqs\t{md5(data).hexdigest()}\t'
+            f'{len(data)}\t1'])
+        self.assertEqual(incomplete, ['S2_R1.fastq.gz', 'S3_R1.fastq.gz'])
+
+    def test_escalate_resources(self):
+        obs = _escalate_resources('16g', '30:00:00', {'OUT_OF_MEMORY'})
+        self.assertEqual(obs, ('32g', '30:00:00'))
+        obs = _escalate_resources('16g', '30:00:00', {'TIMEOUT'})
+        self.assertEqual(obs, ('16g', '60:00:00'))
+        obs = _escalate_resources(
+            '16g', '0:45:30', {'TIMEOUT', 'OUT_OF_MEMORY', 'FAILED'})
+        self.assertEqual(obs, ('32g', '1:31:00'))
+        obs = _escalate_resources('16g', '30:00:00', {'FAILED'})
+        self.assertEqual(obs, ('16g', '30:00:00'))
+
+        # all the formats that Slurm accepts
+        both = {'TIMEOUT', 'OUT_OF_MEMORY'}
+        obs = _escalate_resources('6gb', '1-00:00:00', both)
+        self.assertEqual(obs, ('12gb', '48:00:00'))
+        obs = _escalate_resources('6001', '90', both)
+        self.assertEqual(obs, ('12002', '3:00:00'))
+        obs = _escalate_resources('512M', '2-12', both)
+        self.assertEqual(obs, ('1024M', '120:00:00'))
+        obs = _escalate_resources('16G', '10:30', {'TIMEOUT'})
+        self.assertEqual(obs, ('16G', '0:21:00'))
+        with self.assertRaisesRegex(ValueError, 'Invalid memory: lots'):
+            _escalate_resources('lots', '30:00:00', {'OUT_OF_MEMORY'})
+        with self.assertRaisesRegex(ValueError, 'Invalid walltime: 1:2:3:4'):
+            _escalate_resources('16g', '1:2:3:4', {'TIMEOUT'})
+
+    def test_parse_sacct(self):
+        output = ('1234_1|COMPLETED\n'
+                  '1234_2|OUT_OF_MEMORY\n'
+                  '1234_3|TIMEOUT\n'
+                  '1234_4|CANCELLED by 1000\n'
+                  '1234_[5-6]|PENDING\n'
+                  '1234_1.batch|COMPLETED\n'
+                  '\n')
+        obs = _parse_sacct(output)
+        self.assertEqual(obs, {1: 'COMPLETED', 2: 'OUT_OF_MEMORY',
+                               3: 'TIMEOUT', 4: 'CANCELLED'})
+
+    def test_stream_outputs_leftover_fifos(self):
+        # a task killed for running out of memory leaves its fifos behind
+        fifo_dir = join(self.out_dir, 'fifos')
+        makedirs(fifo_dir)
+        mkfifo(join(fifo_dir, 'S1.fastq'))
+
+        cmd = _stream_outputs(
+            f"printf '@r1\\nACGT\\n+\\nIIII\\n' > {fifo_dir}/S1.fastq",
+            ['S1.fastq'], self.out_dir)
+        obs = run(['bash', '-c', f'set -e; {cmd}'], stdout=PIPE, stderr=PIPE)
+        self.assertEqual(obs.returncode, 0, obs.stderr)
+        with open(join(self.out_dir, 'S1.fastq')) as f:
+            self.assertEqual(f.read(), '@r1\nACGT\n+\nIIII\n')
+        with open(join(self.out_dir, 'S1.fastq.stats')) as f:
+            self.assertTrue(f.read().endswith('\t16\t1\n'))
+        self.assertFalse(exists(join(fifo_dir, 'S1.fastq')))
+
+        # the stats are only kept if the whole command succeeds, like when a
+        # tool in the middle of a pipe is killed
+        cmd = _stream_outputs(
+            f"(printf '@r1\\nACGT\\n+\\nIIII\\n'; exit 137) | "
+            f"cat > {fifo_dir}/S1.fastq", ['S1.fastq'], self.out_dir)
+        obs = run(['bash', '-c', f'set -e; {cmd}'], stdout=PIPE, stderr=PIPE)
+        self.assertEqual(obs.returncode, 137)
+        self.assertFalse(exists(join(self.out_dir, 'S1.fastq.stats')))
+
+        # and a reader that fails, here for a truncated output, fails the task
+        truncated_fp = join(self.out_dir, 'truncated.fastq.gz')
+        with open(truncated_fp, 'wb') as f:
+            f.write(compress(b'@r1\nACGT\n+\nIIII\n')[:-10])
+        cmd = _stream_outputs(f'cat {truncated_fp} > {fifo_dir}/S1.fastq.gz',
+                              ['S1.fastq.gz'], self.out_dir)
+        obs = run(['bash', '-c', f'set -e; {cmd}'], stdout=PIPE, stderr=PIPE)
+        self.assertNotEqual(obs.returncode, 0)
+        self.assertIn(b'is truncated', obs.stderr)
+        self.assertFalse(exists(join(self.out_dir, 'S1.fastq.gz.stats')))
+
+    def _fake_slurm(self, sacct, rejected=()):
+        """Returns a fake subprocess.run that records the sbatch and scancel
+        calls, rejecting the submissions of the scripts in rejected"""
+        self.sbatch = []
+
+        def _run(cmd, **kwargs):
+            returncode = 0
+            error = ''
+            if cmd[0] == 'sacct':
+                output = sacct.pop(0)
+            else:
+                self.sbatch.append(cmd)
+                output = f'Submitted batch job {100 + len(self.sbatch)}'
+                if cmd[-1] in rejected:
+                    returncode = 1
+                    output = ''
+                    error = ('sbatch: error: Batch job submission failed: '
+                             'Requested node configuration is not available')
+
+            class _Result:
+                pass
+            result = _Result()
+            result.returncode = returncode
+            result.stdout = output.encode()
+            result.stderr = error.encode()
+            return result
+
+        return _run
+
+    def test_submit_array(self):
+        main_fp = join(self.out_dir, 'my-job.slurm')
+        finish_fp = join(self.out_dir, 'my-job.finish.slurm')
+        with open(main_fp, 'w') as f:
+            f.write('#!/bin/bash\n#SBATCH --time 30:00:00\n'
+                    '#SBATCH --mem 16g\n')
+        with open(join(self.out_dir, 'fastp_minimap2.array-details'),
+                  'w') as f:
+            f.write('cmd1\ncmd2\ncmd3')
+
+        with patch('qp_fastp_minimap2.qp_fastp_minimap2.run',
+                   self._fake_slurm([])):
+            obs = submit_array(main_fp, finish_fp, self.out_dir, 'my-job')
+            self.assertEqual(obs, ('101', '102'))
+            obs = submit_array(main_fp, finish_fp, self.out_dir, 'my-job',
+                               [2, 3], '32g', '60:00:00')
+            self.assertEqual(obs, ('103', '104'))
+
+        self.assertEqual(self.sbatch, [
+            ['sbatch', main_fp],
+            ['sbatch', '-d', 'afterany:101', finish_fp],
+            ['sbatch', '--array', '2,3%8', '--mem', '32g', '--time',
+             '60:00:00', main_fp],
+            ['sbatch', '-d', 'afterany:103', finish_fp]])
+        with open(join(self.out_dir, 'my-job.array-jobs.tsv')) as f:
+            self.assertEqual(f.read(), '101\t16g\t30:00:00\t1,2,3\n'
+                                       '103\t32g\t60:00:00\t2,3\n')
+
+        # a rejected array job is never recorded
+        with patch('qp_fastp_minimap2.qp_fastp_minimap2.run',
+                   self._fake_slurm([], [main_fp])):
+            with self.assertRaisesRegex(ValueError, 'node configuration'):
+                submit_array(main_fp, finish_fp, self.out_dir, 'my-job',
+                             [2, 3], '64g', '60:00:00')
+        self.assertEqual(len(self.sbatch), 1)
+
+        # and without its finish job the array job is cancelled
+        with patch('qp_fastp_minimap2.qp_fastp_minimap2.run',
+                   self._fake_slurm([], [finish_fp])):
+            with self.assertRaisesRegex(ValueError, 'node configuration'):
+                submit_array(main_fp, finish_fp, self.out_dir, 'my-job',
+                             [2, 3], '64g', '60:00:00')
+        self.assertEqual(self.sbatch[-1], ['scancel', '101'])
+        with open(join(self.out_dir, 'my-job.array-jobs.tsv')) as f:
+            self.assertEqual(len(f.read().splitlines()), 2)
+
+    def test_retry_failed_tasks(self):
+        od = partial(join, self.out_dir)
+        with open(od('my-job.out_files.tsv'), 'w') as f:
+            f.write('\n'.join([
+                f'{od(sn)}_R{r}.fastq.gz\traw_{d}_seqs'
+                for sn in ['S1', 'S2', 'S3', 'S4', 'S5']
+                for r, d in [(1, 'forward'), (2, 'reverse')]]))
+        with open(od('my-job.array-jobs.tsv'), 'w') as f:
+            f.write('101\t16g\t30:00:00\t1,2,3,4,5\n')
+        # S4 and S5 are missing from sacct, S4 finished its command but S5
+        # only got to write its outputs, e.g. killed while exiting
+        with open(od('my-job_4.done'), 'w') as f:
+            f.write('')
+        data = compress(b'@r1\nACGT\n+\nIIII\n')
+        with open(od('in.fastq.gz'), 'wb') as f:
+            f.write(data)
+        for r in [1, 2]:
+            stream_stats(od('in.fastq.gz'), od(f'S5_R{r}.fastq.gz'))
+
+        sacct = ['101_1|COMPLETED\n101_2|OUT_OF_MEMORY\n101_3|FAILED\n'] * 3
+        with patch('qp_fastp_minimap2.qp_fastp_minimap2.run',
+                   self._fake_slurm(sacct)), patch(
+                'qp_fastp_minimap2.qp_fastp_minimap2.sleep'):
+            obs = retry_failed_tasks(self.out_dir, 'my-job')
+        self.assertEqual(obs, [2])
+        # sacct was queried until giving up on S4 and S5
+        self.assertEqual(sacct, [])
+        self.assertEqual(self.sbatch[0][:7], [
+            'sbatch', '--array', '2%8', '--mem', '32g', '--time',
+            '30:00:00'])
+        exp_failed = ('3\tS3_R1.fastq.gz\tFAILED\n'
+                      '5\tS5_R1.fastq.gz\tUNKNOWN\n')
+        with open(od('my-job.failed.tsv')) as f:
+            self.assertEqual(f.read(), exp_failed)
+
+        # the second attempt times out and is retried
+        sacct = ['102_2|TIMEOUT\n']
+        with patch('qp_fastp_minimap2.qp_fastp_minimap2.run',
+                   self._fake_slurm(sacct)):
+            obs = retry_failed_tasks(self.out_dir, 'my-job')
+        self.assertEqual(obs, [2])
+        self.assertEqual(self.sbatch[0][:7], [
+            'sbatch', '--array', '2%8', '--mem', '32g', '--time',
+            '60:00:00'])
+
+        # the third attempt is the last one
+        sacct = ['103_2|OUT_OF_MEMORY\n']
+        with patch('qp_fastp_minimap2.qp_fastp_minimap2.run',
+                   self._fake_slurm(sacct)):
+            obs = retry_failed_tasks(self.out_dir, 'my-job')
+        self.assertEqual(obs, [])
+        self.assertEqual(self.sbatch, [])
+        with open(od('my-job.failed.tsv')) as f:
+            self.assertEqual(f.read(), exp_failed +
+                             '2\tS2_R1.fastq.gz\tOUT_OF_MEMORY\n')
+
+    def test_retry_failed_tasks_rejected(self):
+        od = partial(join, self.out_dir)
+        with open(od('my-job.out_files.tsv'), 'w') as f:
+            f.write('\n'.join([f'{od(sn)}_R1.fastq.gz\traw_forward_seqs'
+                               for sn in ['S1', 'S2']]))
+        with open(od('my-job.array-jobs.tsv'), 'w') as f:
+            f.write('101\t16gb\t1-00:00:00\t1,2\n')
+
+        # sbatch rejects the escalated resources so the samples fail for good
+        # and the job continues to report them
+        sacct = ['101_1|TIMEOUT\n101_2|COMPLETED\n']
+        with patch('qp_fastp_minimap2.qp_fastp_minimap2.run',
+                   self._fake_slurm(sacct, [od('my-job.slurm')])):
+            obs = retry_failed_tasks(self.out_dir, 'my-job')
+        self.assertEqual(obs, [])
+        with open(od('my-job.failed.tsv')) as f:
+            self.assertEqual(
+                f.read(), '1\tS1_R1.fastq.gz\tTIMEOUT, not retried\n')
+
+        # as are the ones whose resources can't be parsed
+        remove(od('my-job.failed.tsv'))
+        with open(od('my-job.array-jobs.tsv'), 'w') as f:
+            f.write('101\tlots\t30:00:00\t1,2\n')
+        sacct = ['101_1|OUT_OF_MEMORY\n101_2|COMPLETED\n']
+        with patch('qp_fastp_minimap2.qp_fastp_minimap2.run',
+                   self._fake_slurm(sacct)):
+            obs = retry_failed_tasks(self.out_dir, 'my-job')
+        self.assertEqual(obs, [])
+        self.assertEqual(self.sbatch, [])
+        with open(od('my-job.failed.tsv')) as f:
+            self.assertEqual(
+                f.read(), '1\tS1_R1.fastq.gz\tOUT_OF_MEMORY, not retried\n')
+
+    def test_fastp_minimap2_finish(self):
+        od = partial(join, self.out_dir)
+        out_files = [(od(f'{sn}_R{r}.fastq.gz'), f'raw_{d}_seqs')
+                     for sn in ['S1', 'S2']
+                     for r, d in [(1, 'forward'), (2, 'reverse')]]
+        with open(od('my-job.out_files.tsv'), 'w') as f:
+            f.write('\n'.join([f'{fp}\t{ft}' for fp, ft in out_files]))
+        data = compress(b'@r1\nACGT\n+\nIIII\n')
+        with open(od('in.fastq.gz'), 'wb') as f:
+            f.write(data)
+        for fp, _ in out_files:
+            stream_stats(od('in.fastq.gz'), fp)
+        qclient = MagicMock()
+
+        success, ainfo, msg = fastp_minimap2(
+            qclient, 'my-job', self.params, self.out_dir)
+        self.assertTrue(success)
+        self.assertEqual(msg, '')
+        self.assertEqual(ainfo[0].files, out_files)
+        with open(od('my-job.stats.tsv')) as f:
+            obs = f.read()
+        checksum = md5(data).hexdigest()
+        self.assertEqual(obs, 'filepath\tfilepath_type\tmd5\tsize\trecords\n' +
+                         ''.join([f'{fp}\t{ft}\t{checksum}\t{len(data)}\t1\n'
+                                  for fp, ft in out_files]))
+
+        # an output that was never completely written
+        remove(f'{out_files[3][0]}.stats')
+        success, ainfo, msg = fastp_minimap2(
+            qclient, 'my-job', self.params, self.out_dir)
+        self.assertFalse(success)
+        self.assertIsNone(ainfo)
+        self.assertEqual(msg, 'These files were not completely written: '
+                              'S2_R2.fastq.gz')
+
+        # the samples that failed for good are listed by the finish job,
+        # which still prunes the fastp cache
+        with open(od('my-job.failed.tsv'), 'w') as f:
+            f.write('1\tS1_R1.fastq.gz\tFAILED\n'
+                    '2\tS2_R1.fastq.gz\tOUT_OF_MEMORY, not retried\n')
+        prefix = 'qp_fastp_minimap2.qp_fastp_minimap2'
+        with patch(f'{prefix}.QC_FASTP_CACHE', '/foo/bar/cache'), patch(
+                f'{prefix}._prune_fastp_cache') as prune:
+            success, ainfo, msg = fastp_minimap2(
+                qclient, 'my-job', self.params, self.out_dir)
+        prune.assert_called_once_with(
+            '/foo/bar/cache', QC_FASTP_CACHE_SIZE * 1024 ** 3)
+        self.assertFalse(success)
+        self.assertIsNone(ainfo)
+        self.assertEqual(msg, 'These samples failed: S1_R1.fastq.gz '
+                              '(FAILED), S2_R1.fastq.gz (OUT_OF_MEMORY, not '
+                              'retried)')
+
+    def test_resolve_environment(self):
+        # the host and session variables of the submission are never exported
+        # even if set by the environment
+        environment = (f'{environ["ENVIRONMENT"]}; export TMPDIR=/scratch; '
+                       'export SSH_CONNECTION=host; export HOME=$HOME')
+        with patch.dict(environ, {'QP_SUBMISSION_ONLY': 'value'}):
+            obs = resolve_environment(environment, self.out_dir, 'my-job')
+        snapshot_fp = join(self.out_dir, 'my-job.environment.sh')
+        self.assertEqual(obs, f'source {snapshot_fp}')
+        with open(snapshot_fp) as f:
+            snapshot = f.read()
+        self.assertIn('\nexport PATH=', snapshot)
+        # the variables are exported even if they are already set
+        self.assertIn(
+            f'\nexport QC_REFERENCE_DB={QC_REFERENCE_DB}\n', snapshot)
+        # but only the ones set or changed by the environment
+        for name in ['SHLVL', 'QP_SUBMISSION_ONLY', 'TMPDIR', 'SSH_CONNECTION',
+                     'HOME']:
+            self.assertNotIn(f'\nexport {name}=', snapshot)
+        for tool in ['fastp', 'minimap2', 'samtools']:
+            self.assertRegex(snapshot, f'hash -p /.*/{tool} {tool}\n')
+
+        with self.assertRaisesRegex(ValueError, 'Missing tools'):
+            resolve_environment('export PATH=/dev/null', self.out_dir,
+                                'my-job')
+
+    def test_subsample(self):
+        in_fp = join(self.out_dir, 'in.fastq.gz')
+        out_fp = join(self.out_dir, 'out.fastq.gz')
+        records = [b'@r%d\nACGT\n+\nIIII\n' % i for i in range(10)]
+        with open(in_fp, 'wb') as f:
+            f.write(compress(b''.join(records)))
+
+        _subsample(in_fp, out_fp, 3)
+        with open(out_fp, 'rb') as f:
+            self.assertEqual(decompress(f.read()), b''.join(records[:3]))
+
+        # asking for more reads than available
+        _subsample(in_fp, out_fp, 20)
+        with open(out_fp, 'rb') as f:
+            self.assertEqual(decompress(f.read()), b''.join(records))
+
+    def _quick_look(self, commands, paired=True):
+        """Runs fastp_minimap2_quick_look with commands instead of the real
+        ones over 2 samples"""
+        od = partial(join, self.out_dir)
+        files = {}
+        out_files = []
+        for sn in ['S1', 'S2']:
+            files[sn] = [None, None]
+            for i, d in enumerate(['forward', 'reverse'][:1 + paired]):
+                fp = od(f'{sn}_R{i + 1}.fastq.gz')
+                with open(fp, 'wb') as f:
+                    f.write(compress(b'@r1\nACGT\n+\nIIII\n' * 20))
+                files[sn][i] = {'filepath': fp}
+                out_files.append((od('out', basename(fp)), f'raw_{d}_seqs'))
+        makedirs(od('out'))
+
+        qclient = MagicMock()
+        qclient.artifact_and_preparation_files.return_value = (files, None)
+        params = {'input': 1, 'reference': 'artifacts', 'threads': 2,
+                  'reads': 5}
+        with patch('qp_fastp_minimap2.qp_fastp_minimap2._generate_commands',
+                   return_value=(commands, out_files)):
+            obs = fastp_minimap2_quick_look(
+                qclient, 'my-job', params, od('out'))
+
+        # the real commands would have run over the subsampled reads
+        with open(od('out', 'subsampled', 'S1_R1.fastq.gz'), 'rb') as f:
+            self.assertEqual(
+                decompress(f.read()), b'@r1\nACGT\n+\nIIII\n' * 5)
+
+        return obs, out_files
+
+    def test_fastp_minimap2_quick_look(self):
+        report = ('{"summary": {"before_filtering": {"total_reads": 10}, '
+                  '"after_filtering": {"total_reads": %d}}, '
+                  '"adapter_cutting": {"adapter_trimmed_reads": %d}}')
+        # each output has a single read, like in stream_stats
+        out = partial(join, self.out_dir, 'out')
+        commands = []
+        for sn, passed, trimmed in [('S1', 8, 3), ('S2', 4, 0)]:
+            cmd = f"echo '{report % (passed, trimmed)}' > fastp.json"
+            for r in [1, 2]:
+                fp = out(f'{sn}_R{r}.fastq.gz')
+                cmd += (f"; printf '@r1\\nACGT\\n+\\nIIII\\n' > {fp}; "
+                        f"printf 'md5\\t16\\t1\\n' > {fp}.stats")
+            commands.append(cmd)
+
+        (success, ainfo, msg), out_files = self._quick_look(commands)
+        self.assertTrue(success)
+        self.assertEqual(msg, '')
+        # the summary is its own artifact with the fastp reports
+        self.assertEqual(ainfo[0].files, out_files)
+        self.assertEqual(ainfo[1].output_name, 'Quick-look summary')
+        self.assertEqual(ainfo[1].artifact_type, 'job-output-folder')
+        self.assertEqual(ainfo[1].files, [(out('quick_look/'), 'directory')])
+        self.assertTrue(exists(out('quick_look', 'S1', 'fastp.json')))
+        with open(out('quick_look', 'quick_look.tsv')) as f:
+            obs = f.read()
+        self.assertEqual(obs, (
+            'sample_name\treads\tadapter_trimmed_reads\t'
+            'passed_fastp_reads\tfiltered_reads\thost_fraction\n'
+            'S1\t10\t3\t8\t2\t0.7500\n'
+            'S2\t10\t0\t4\t2\t0.5000\n'))
+
+    def test_fastp_minimap2_quick_look_partial(self):
+        # S1 finishes but S2 runs out of time, so the summary lists S2
+        # without results and only the summary is returned
+        out = partial(join, self.out_dir, 'out')
+        fp = out('S1_R1.fastq.gz')
+        commands = [
+            'echo \'{"summary": {"before_filtering": {"total_reads": 10}, '
+            '"after_filtering": {"total_reads": 8}}}\' > fastp.json; '
+            f"printf '@r1\\nACGT\\n+\\nIIII\\n' > {fp}; "
+            f"printf 'md5\\t16\\t1\\n' > {fp}.stats",
+            'sleep 60']
+        start = time()
+        with patch('qp_fastp_minimap2.qp_fastp_minimap2.QUICK_LOOK_TIMEOUT',
+                   3):
+            (success, ainfo, msg), _ = self._quick_look(
+                commands, paired=False)
+        self.assertLess(time() - start, 30)
+        self.assertTrue(success)
+        self.assertEqual(msg, '')
+        self.assertEqual(len(ainfo), 1)
+        self.assertEqual(ainfo[0].artifact_type, 'job-output-folder')
+        with open(out('quick_look', 'quick_look.tsv')) as f:
+            obs = f.read()
+        self.assertEqual(obs, (
+            'sample_name\treads\tadapter_trimmed_reads\t'
+            'passed_fastp_reads\tfiltered_reads\thost_fraction\n'
+            'S1\t10\t0\t8\t1\t0.8750\n'
+            'S2\tNA\tNA\tNA\tNA\tNA\n'))
+
+    def test_fastp_minimap2_quick_look_failure(self):
+        # the background process stands in for a stats reader that would
+        # wait forever for its fifo
+        start = time()
+        commands = ['echo {} > fastp.json',
+                    'sleep 60 & echo something went wrong; exit 1']
+        (success, ainfo, msg), _ = self._quick_look(commands, paired=False)
+        self.assertFalse(success)
+        self.assertIsNone(ainfo)
+        self.assertEqual(msg, 'S2 failed:\nsomething went wrong\n')
+        self.assertLess(time() - start, 30)
+
+    def test_fastp_minimap2_quick_look_timeout(self):
+        start = time()
+        with patch('qp_fastp_minimap2.qp_fastp_minimap2.QUICK_LOOK_TIMEOUT',
+                   1):
+            (success, ainfo, msg), _ = self._quick_look(
+                ['sleep 60', 'sleep 60'], paired=False)
+        self.assertFalse(success)
+        self.assertEqual(msg, 'The quick-look did not finish within 1 '
+                              'seconds, S1 was running')
+        self.assertLess(time() - start, 30)
+
+    def test_start_quick_look(self):
+        # the quick-look is run by the plugin itself instead of Slurm
+        execute = run_path(join(
+            dirname(dirname(dirname(__file__))), 'scripts',
+            'start_qp_fastp_minimap2'))['execute'].callback
+        qclient = MagicMock()
+        qclient.get_job_info.return_value = {
+            'command': fastp_minimap2_quick_look_cmd.name,
+            'parameters': {'input': 1}}
+        mock_plugin = MagicMock()
+        with patch.dict(execute.__globals__, {
+                'plugin': mock_plugin,
+                'client_connect': lambda url: qclient,
+                'submit_array': None}):
+            execute('my-url', 'my-job', self.out_dir)
+        mock_plugin.assert_called_once_with('my-url', 'my-job', self.out_dir)
+        qclient.update_job_step.assert_not_called()
+
+    def test_start_rejected(self):
+        # a job that sbatch rejects is completed as failed right away
+        execute = run_path(join(
+            dirname(dirname(dirname(__file__))), 'scripts',
+            'start_qp_fastp_minimap2'))['execute'].callback
+        qclient = MagicMock()
+        qclient.get_job_info.return_value = {
+            'command': 'Adapter and host filtering v2023.12',
+            'parameters': {'input': 1}}
+        qclient.artifact_and_preparation_files.return_value = ({}, None)
+
+        def _submit_array(*args):
+            raise ValueError('sbatch: error: invalid partition')
+        with patch.dict(execute.__globals__, {
+                'client_connect': lambda url: qclient,
+                'resolve_environment': lambda *args: 'source env.sh',
+                'fastp_minimap2_to_array': lambda *args: (
+                    'main.slurm', 'finish.slurm', 'out_files.tsv'),
+                'submit_array': _submit_array}):
+            execute('my-url', 'my-job', self.out_dir)
+        qclient.complete_job.assert_called_once_with(
+            'my-job', False, error_msg='sbatch: error: invalid partition')
+
     def test_fastp_minimap2(self):
         # inserting new prep template
         prep_info_dict = {
@@ -199,6 +997,7 @@ class FastpMinimap2Tests(PluginTestCase):
             f'cmd=$(head -n $step {out_dir}/fastp_minimap2.array-details | '
             'tail -n 1)\n',
             'eval $cmd\n',
+            f'touch {out_dir}/{job_id}_${{SLURM_ARRAY_TASK_ID}}.done\n',
             'set +e\n',
             'date\n']
         self.assertEqual(main, exp_main)
@@ -235,21 +1034,31 @@ class FastpMinimap2Tests(PluginTestCase):
         # the easiest to figure out the location of the artifact input files
         # is to check the first file of the raw forward reads
         apath = dirname(fps['raw_forward_seqs'][0])
-        exp_commands = [
-            f'fastp -l 100 -i {apath}/S22205_S104_L001_R1_001.fastq.gz -w 2 '
-            f'--adapter_fasta {out_dir}/fastp_known_adapters_formatted.fna '
-            f'-I {apath}/S22205_S104_L001_R2_001.fastq.gz --stdout | '
-            f'minimap2 -ax sr -t 2 {QC_REFERENCE_DB}artifacts.mmi - -a  | '
-            'samtools fastq -@ 2 -f  12 -F 256 -1 '
-            f'{out_dir}/S22205_S104_L001_R1_001.fastq.gz -2 '
-            f'{out_dir}/S22205_S104_L001_R2_001.fastq.gz\n',
-            f'fastp -l 100 -i {apath}/S22282_S102_L001_R1_001.fastq.gz -w 2 '
-            f'--adapter_fasta {out_dir}/fastp_known_adapters_formatted.fna '
-            f'-I {apath}/S22282_S102_L001_R2_001.fastq.gz --stdout | '
-            f'minimap2 -ax sr -t 2 {QC_REFERENCE_DB}artifacts.mmi - -a  | '
-            'samtools fastq -@ 2 -f  12 -F 256 -1 '
-            f'{out_dir}/S22282_S102_L001_R1_001.fastq.gz -2 '
-            f'{out_dir}/S22282_S102_L001_R2_001.fastq.gz']
+        # the outputs are written to fifos and streamed to out_dir
+        fd = f'{out_dir}/fifos'
+        exp_commands = []
+        for sample in ['S22205_S104', 'S22282_S102']:
+            r1 = f'{sample}_L001_R1_001.fastq.gz'
+            r2 = f'{sample}_L001_R2_001.fastq.gz'
+            exp_commands.append(
+                f'set -o pipefail; mkdir -p {fd}; '
+                f'rm -f {fd}/{r1} {fd}/{r2} {fd}/{r1}.stats {fd}/{r2}.stats '
+                f'{out_dir}/{r1}.stats {out_dir}/{r2}.stats; '
+                f'mkfifo {fd}/{r1} {fd}/{r2}; '
+                f'stats_qp_fastp_minimap2 {fd}/{r1} {out_dir}/{r1} '
+                f'{fd}/{r1}.stats & pid0=$!; '
+                f'stats_qp_fastp_minimap2 {fd}/{r2} {out_dir}/{r2} '
+                f'{fd}/{r2}.stats & pid1=$!; '
+                f'fastp -l 100 -i {apath}/{r1} -w 2 --adapter_fasta '
+                f'{out_dir}/fastp_known_adapters_formatted.fna '
+                f'-I {apath}/{r2} --stdout | '
+                f'minimap2 -ax sr -t 2 {QC_REFERENCE_DB}artifacts.mmi - -a  | '
+                'samtools fastq -@ 2 -f  12 -F 256 -1 '
+                f'{fd}/{r1} -2 {fd}/{r2}; wait $pid0; wait $pid1; '
+                f'mv {fd}/{r1}.stats {out_dir}/{r1}.stats; '
+                f'mv {fd}/{r2}.stats {out_dir}/{r2}.stats; '
+                f'rm {fd}/{r1} {fd}/{r2}\n')
+        exp_commands[-1] = exp_commands[-1][:-1]
         self.assertEqual(commands, exp_commands)
 
     def test_fastp_minimap2_just_fwd(self):
@@ -349,6 +1158,7 @@ class FastpMinimap2Tests(PluginTestCase):
             f'cmd=$(head -n $step {out_dir}/fastp_minimap2.array-details | '
             'tail -n 1)\n',
             'eval $cmd\n',
+            f'touch {out_dir}/{job_id}_${{SLURM_ARRAY_TASK_ID}}.done\n',
             'set +e\n',
             'date\n']
         self.assertEqual(main, exp_main)
@@ -383,17 +1193,24 @@ class FastpMinimap2Tests(PluginTestCase):
         # the easiest to figure out the location of the artifact input files
         # is to check the first file of the raw forward reads
         apath = dirname(fps['raw_forward_seqs'][0])
-        exp_commands = [
-            f'fastp -l 100 -i {apath}/S22205_S104_L001_R1_001.fastq.gz -w 2 '
-            f'--adapter_fasta {out_dir}/fastp_known_adapters_formatted.fna '
-            f'--stdout | minimap2 -ax sr -t 2 {QC_REFERENCE_DB}artifacts.mmi '
-            '- -a  | samtools fastq -@ 2 -f  4 -0 '
-            f'{out_dir}/S22205_S104_L001_R1_001.fastq.gz\n',
-            f'fastp -l 100 -i {apath}/S22282_S102_L001_R1_001.fastq.gz -w 2 '
-            f'--adapter_fasta {out_dir}/fastp_known_adapters_formatted.fna '
-            f'--stdout | minimap2 -ax sr -t 2 {QC_REFERENCE_DB}artifacts.mmi '
-            '- -a  | samtools fastq -@ 2 -f  4 -0 '
-            f'{out_dir}/S22282_S102_L001_R1_001.fastq.gz']
+        # the outputs are written to fifos and streamed to out_dir
+        fd = f'{out_dir}/fifos'
+        exp_commands = []
+        for sample in ['S22205_S104', 'S22282_S102']:
+            r1 = f'{sample}_L001_R1_001.fastq.gz'
+            exp_commands.append(
+                f'set -o pipefail; mkdir -p {fd}; rm -f {fd}/{r1} '
+                f'{fd}/{r1}.stats {out_dir}/{r1}.stats; mkfifo {fd}/{r1}; '
+                f'stats_qp_fastp_minimap2 {fd}/{r1} {out_dir}/{r1} '
+                f'{fd}/{r1}.stats & pid0=$!; '
+                f'fastp -l 100 -i {apath}/{r1} -w 2 --adapter_fasta '
+                f'{out_dir}/fastp_known_adapters_formatted.fna '
+                '--stdout | minimap2 -ax sr -t 2 '
+                f'{QC_REFERENCE_DB}artifacts.mmi - -a  | '
+                'samtools fastq -@ 2 -f  4 -0 '
+                f'{fd}/{r1}; wait $pid0; '
+                f'mv {fd}/{r1}.stats {out_dir}/{r1}.stats; rm {fd}/{r1}\n')
+        exp_commands[-1] = exp_commands[-1][:-1]
         self.assertEqual(commands, exp_commands)
 
 